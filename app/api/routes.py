@@ -1,65 +1,340 @@
-from typing import List
-from fastapi import APIRouter, File, UploadFile, HTTPException, status, Request, Depends
+import asyncio
+import logging
+import os
+import shutil
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from urllib.parse import unquote
+from cachetools import TTLCache
+from fastapi import APIRouter, File, UploadFile, HTTPException, status, Request, Header, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.types import ASGIApp, Receive, Scope, Send
+import orjson
+import xxhash
 from app.models.schemas import ChatMessage, ChatResponse, UploadResponse, StatusResponse, DocumentWithId, DeleteResponse
-from app.services.document_processor import DocumentProcessor
+from app.services.document_processor import DocumentProcessor, TEXT_STORE_DIR
 from app.services.retrieval import RetrievalService
+from app.services.session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# Sessions idle for longer than the TTL, or beyond the size cap, are evicted
+SESSION_CACHE_MAXSIZE = 1024
+SESSION_TTL_SECONDS = 3600
+
+def release_services(services: tuple):
+    """Free the documents held by an evicted session; its vector store goes with the last reference to it"""
+    document_processor, _ = services
+    # With a shared store the session may live on in another worker, so its files are kept
+    if session_store is None:
+        document_processor.clear_documents()
+
+class SessionServicesCache(TTLCache):
+    """TTL/LRU cache of per-session services that releases them on eviction"""
+    
+    def popitem(self):
+        session_id, services = super().popitem()
+        release_services(services)
+        return session_id, services
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, services in expired:
+            release_services(services)
+        return expired
 
 # Initialize services - now session-based
-document_processors = {}  # session_id -> DocumentProcessor
-retrieval_services = {}   # session_id -> RetrievalService
+user_services = SessionServicesCache(maxsize=SESSION_CACHE_MAXSIZE, ttl=SESSION_TTL_SECONDS)  # session_id -> (DocumentProcessor, RetrievalService)
+
+# Shared session metadata for multi-worker deployments (None when REDIS_URL is unset)
+session_store = SessionStore.from_env(SESSION_TTL_SECONDS)
+# Sessions whose shared-store expiry was extended recently; later requests only check the version
+recently_touched = TTLCache(maxsize=SESSION_CACHE_MAXSIZE, ttl=SESSION_TTL_SECONDS // 4)
+# Shared-store version each cached session was loaded or last saved at
+session_versions = TTLCache(maxsize=SESSION_CACHE_MAXSIZE, ttl=SESSION_TTL_SECONDS)
+# In-flight service creation per session, so concurrent first requests share one restore
+pending_services: Dict[str, asyncio.Future] = {}
+# How often shared session directories are checked for sessions that expired from the shared store
+SESSION_SWEEP_INTERVAL_SECONDS = 600
+
+# Serialized GET responses keyed by (session_id, path), each tagged with the ETag it was built for
+RESPONSE_CACHE_TTL_SECONDS = 30
+response_cache = TTLCache(maxsize=SESSION_CACHE_MAXSIZE * 3, ttl=RESPONSE_CACHE_TTL_SECONDS)
+
+# Answers keyed by a hash of (session state, normalized question)
+CHAT_CACHE_MAXSIZE = 10_000
+CHAT_CACHE_TTL_SECONDS = 600
+chat_cache = TTLCache(maxsize=CHAT_CACHE_MAXSIZE, ttl=CHAT_CACHE_TTL_SECONDS)
+
+# Session and services bound to the current API request by SessionServicesMiddleware
+_current_session_id: ContextVar[str] = ContextVar("current_session_id")
+_current_services: ContextVar[tuple] = ContextVar("current_services")
 
 router = APIRouter()
 
+# Held so the event loop's weak reference is not the only one keeping the task alive
+_sweeper_task: Optional[asyncio.Task] = None
+
+@router.on_event("startup")
+async def start_session_dir_sweeper():
+    """Clean up after sessions that expired from the shared store; their files outlive every worker's cache"""
+    global _sweeper_task
+    if session_store is not None:
+        _sweeper_task = asyncio.create_task(sweep_session_dirs_periodically())
+
 def get_session_id(request: Request) -> str:
     """Get session ID from request"""
     return request.session.get("session_id", "default")
 
-def get_user_services(session_id: str = Depends(get_session_id)):
+def create_user_services(session_id: str) -> tuple:
+    """Create a fresh service pair for one session"""
+    # Shared sessions keep their text and vector index where every worker on the host can find them
+    if session_store is None:
+        return DocumentProcessor(), RetrievalService()
+    text_dir = os.path.join(TEXT_STORE_DIR, session_id)
+    return DocumentProcessor(text_dir=text_dir), RetrievalService(index_path=os.path.join(text_dir, "index"))
+
+async def load_user_services(session_id: str) -> tuple:
+    """Create a session's services off the event loop and restore any state persisted by another worker"""
+    loop = asyncio.get_running_loop()
+    services = await loop.run_in_executor(None, create_user_services, session_id)
+    document_processor, retrieval_service = services
+    
+    if session_store is not None:
+        documents, document_id_counter, version = await session_store.load(session_id)
+        session_versions[session_id] = version
+        if documents:
+            document_processor.restore_documents(documents, document_id_counter)
+            texts, names = document_processor.get_remaining_texts_and_names()
+            if names and not await loop.run_in_executor(None, retrieval_service.load, len(names)):
+                logger.info("Restoring %d documents for session from shared store", len(names))
+                document_ids = [doc["id"] for doc in document_processor.uploaded_documents]
+                await retrieval_service.add_documents(texts, names, document_ids)
+    
+    user_services[session_id] = services
+    return services
+
+async def get_user_services(session_id: str) -> tuple:
     """Get or create user-specific services"""
-    if session_id not in document_processors:
-        document_processors[session_id] = DocumentProcessor()
-        retrieval_services[session_id] = RetrievalService()
+    services = user_services.get(session_id)
+    if services is not None and session_store is not None:
+        # Another worker may have changed the session since this one loaded it; one round trip per request
+        extend = session_id not in recently_touched
+        version = await session_store.touch(session_id, extend=extend)
+        if extend:
+            recently_touched[session_id] = True
+        if version != session_versions.get(session_id):
+            logger.info("Session changed in shared store (version %d), reloading", version)
+            services = None
+        else:
+            session_versions[session_id] = version
     
-    return document_processors[session_id], retrieval_services[session_id]
+    if services is None:
+        pending = pending_services.get(session_id)
+        if pending is None:
+            pending = pending_services[session_id] = asyncio.ensure_future(load_user_services(session_id))
+            pending.add_done_callback(lambda _: pending_services.pop(session_id, None))
+        services = await asyncio.shield(pending)
+        
+        # Freshly loaded sessions still need their shared-store expiry extended
+        if session_store is not None and session_id not in recently_touched:
+            recently_touched[session_id] = True
+            await session_store.touch(session_id)
+    
+    # Re-inserting refreshes the TTL so active sessions are never evicted
+    user_services[session_id] = services
+    return services
+
+async def warm_user_services(session_id: str):
+    """Create a session's services ahead of its first API call"""
+    await get_user_services(session_id)
+
+async def persist_current_session():
+    """Write the current session's document metadata to the shared store, if one is configured"""
+    if session_store is None:
+        return
+    
+    session_id = _current_session_id.get()
+    document_processor, _ = _current_services.get()
+    # Recording our own write keeps this worker from reloading the state it just saved
+    session_versions[session_id] = await session_store.save(
+        session_id,
+        document_processor.uploaded_documents,
+        document_processor.document_id_counter
+    )
+
+async def sweep_expired_session_dirs():
+    """Delete shared session directories whose session expired from the shared store"""
+    loop = asyncio.get_running_loop()
+    try:
+        session_ids = await loop.run_in_executor(None, os.listdir, TEXT_STORE_DIR)
+    except FileNotFoundError:
+        return
+    
+    # A directory written within the TTL may belong to an upload that has not saved its metadata yet
+    cutoff = time.time() - SESSION_TTL_SECONDS
+    for session_id in session_ids:
+        session_dir = os.path.join(TEXT_STORE_DIR, session_id)
+        try:
+            if os.path.getmtime(session_dir) > cutoff:
+                continue
+        except OSError:
+            continue
+        if session_id in user_services or await session_store.exists(session_id):
+            continue
+        logger.info("Removing files of expired session %s", session_id)
+        await loop.run_in_executor(None, shutil.rmtree, session_dir, True)
+
+async def sweep_session_dirs_periodically():
+    """Run sweep_expired_session_dirs for the lifetime of the worker"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            await sweep_expired_session_dirs()
+        except Exception:
+            logger.exception("Sweeping expired session directories failed")
+
+def get_current_services() -> tuple:
+    """Services of the session handling the current request"""
+    return _current_services.get()
+
+class SessionServicesMiddleware:
+    """Resolve the session's services once per API request and bind them to a context variable"""
+    
+    def __init__(self, app: ASGIApp, path_prefix: str = "/api"):
+        self.app = app
+        self.path_prefix = path_prefix
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+        
+        # Populated by SessionMiddleware, which must wrap this middleware
+        session_id = scope["session"].get("session_id", "default")
+        session_token = _current_session_id.set(session_id)
+        services_token = _current_services.set(await get_user_services(session_id))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_services.reset(services_token)
+            _current_session_id.reset(session_token)
+
+def build_etag(session_id: str, services: tuple) -> str:
+    """ETag for a session's read endpoints; changes whenever documents or the index change"""
+    document_processor, retrieval_service = services
+    retrieval_status = retrieval_service.get_status()
+    # The shared-store version tells apart services reloaded after another worker changed the session
+    store_version = session_versions.get(session_id, 0)
+    return f'"{session_id}:{store_version}:{document_processor.cache_version}:{retrieval_status["document_count"]}:{int(retrieval_status["ready_for_queries"])}"'
+
+def to_json_bytes(payload: Any) -> bytes:
+    """Serialize a response body with pydantic-core or orjson, skipping FastAPI's jsonable_encoder"""
+    if isinstance(payload, BaseModel):
+        return payload.model_dump_json().encode("utf-8")
+    return orjson.dumps(payload)
+
+def cached_json_response(request: Request, services: tuple, build_body: Callable[[], Any]) -> Response:
+    """Serve a read endpoint from the response cache, answering 304 when the client copy is current"""
+    session_id = get_session_id(request)
+    etag = build_etag(session_id, services)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    cache_key = (session_id, request.url.path)
+    cached = response_cache.get(cache_key)
+    if cached is not None and cached[0] == etag:
+        body = cached[1]
+    else:
+        body = to_json_bytes(build_body())
+        response_cache[cache_key] = (etag, body)
+    
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @router.post("/upload", response_model=UploadResponse)
-async def upload_documents(files: List[UploadFile] = File(...), services: tuple = Depends(get_user_services)):
+async def upload_documents(files: List[UploadFile] = File(...)):
     """Upload and process multiple PDF documents with enhanced support"""
     
-    document_processor, retrieval_service = services
+    document_processor, retrieval_service = get_current_services()
     
     try:
         # Process uploaded files
         texts, document_info = await document_processor.process_uploaded_files(files)
         document_names = [info["filename"] for info in document_info]
         
-        print(f"Processing {len(files)} files: {document_names}")
+        logger.info("Processing %d files: %s", len(files), document_names)
         
         # Add documents to retrieval service
-        retrieval_service.add_documents(texts, document_names)
+        await retrieval_service.add_documents(texts, document_names, [info["id"] for info in document_info])
+        await persist_current_session()
         
-        # Get document statistics
-        stats = document_processor.get_document_stats()
-        
-        return UploadResponse(
-            message=f"Successfully uploaded and processed {len(files)} document(s). Total: {stats['total_documents']} documents, {stats['total_pages']} pages.",
-            documents=document_names,
-            total_documents=stats['total_documents']
-        )
+        return build_upload_response(document_processor, document_names)
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error in upload endpoint: {str(e)}")
+        logger.exception("Error in upload endpoint")
         raise HTTPException(status_code=500, detail=f"Error processing documents: {str(e)}")
 
+@router.post("/upload/raw", response_model=UploadResponse)
+async def upload_raw_document(
+    request: Request,
+    x_filename: str = Header(..., description="URL-encoded name of the PDF sent as the request body")
+):
+    """Upload a single PDF sent as the raw request body, bypassing multipart parsing"""
+    
+    document_processor, retrieval_service = get_current_services()
+    filename = unquote(x_filename)
+    
+    try:
+        document_processor.validate_filename(filename)
+        
+        # Stream the body straight to disk without buffering it
+        text, doc_info = await document_processor.process_stream(filename, request.stream())
+        
+        logger.info("Processing raw upload: %s", filename)
+        
+        # Add document to retrieval service
+        await retrieval_service.add_documents([text], [doc_info["filename"]], [doc_info["id"]])
+        await persist_current_session()
+        
+        return build_upload_response(document_processor, [doc_info["filename"]])
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error in raw upload endpoint")
+        raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
+
+def build_upload_response(document_processor: DocumentProcessor, document_names: List[str]) -> UploadResponse:
+    """Summarize a successful upload together with the session's document statistics"""
+    stats = document_processor.get_document_stats()
+    
+    return UploadResponse(
+        message=f"Successfully uploaded and processed {len(document_names)} document(s). Total: {stats['total_documents']} documents, {stats['total_pages']} pages.",
+        documents=document_names,
+        total_documents=stats['total_documents']
+    )
+
 @router.post("/chat", response_model=ChatResponse)
-async def chat(message: ChatMessage, services: tuple = Depends(get_user_services)):
+async def chat(message: ChatMessage):
     """Process chat message and return response with enhanced source information"""
     
+    services = get_current_services()
     document_processor, retrieval_service = services
     
     try:
-        # Query the documents
-        result = retrieval_service.query(message.message)
+        # Repeat questions are answered from the cache without retrieval or an LLM call
+        cache_key = build_chat_cache_key(services, message.message)
+        result = chat_cache.get(cache_key)
+        if result is None:
+            # Query the documents
+            result = await retrieval_service.query(message.message)
+            chat_cache[cache_key] = result
         
         return ChatResponse(
             response=result["answer"],
@@ -67,69 +342,132 @@ async def chat(message: ChatMessage, services: tuple = Depends(get_user_services
         )
         
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
+        logger.exception("Error in chat endpoint")
         raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
 
-@router.get("/status", response_model=StatusResponse)
-async def get_status(services: tuple = Depends(get_user_services)):
-    """Get current status of the RAG bot with detailed information"""
+@router.post("/chat/stream")
+async def chat_stream(message: ChatMessage):
+    """Stream the answer as Server-Sent Events: token events, then a final sources event"""
     
+    services = get_current_services()
     document_processor, retrieval_service = services
     
-    # Get document stats
-    doc_stats = document_processor.get_document_stats()
-    retrieval_status = retrieval_service.get_status()
+    # Fail with a proper status code while it can still be sent
+    retrieval_service.ensure_ready()
     
-    document_names = [doc["filename"] for doc in doc_stats["documents"]]
+    cache_key = build_chat_cache_key(services, message.message)
+    result = chat_cache.get(cache_key)
+    if result is None:
+        events = cache_streamed_answer(cache_key, retrieval_service.astream_query(message.message))
+    else:
+        events = replay_cached_answer(result)
     
-    return StatusResponse(
-        documents_uploaded=doc_stats["total_documents"],
-        documents=document_names,
-        ready_for_chat=retrieval_status["ready_for_queries"]
+    return StreamingResponse(
+        sse_wrap(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
+def build_chat_cache_key(services: tuple, message: str) -> str:
+    """Hash of the session state and the normalized question; any upload, delete or reset changes it"""
+    normalized = " ".join(message.split()).lower()
+    return xxhash.xxh64(f"{build_etag(_current_session_id.get(), services)}:{normalized}".encode()).hexdigest()
+
+async def cache_streamed_answer(cache_key: str, events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Pass streamed events through and cache the full answer once the final sources event arrives"""
+    tokens = []
+    async for event in events:
+        if "token" in event:
+            tokens.append(event["token"])
+        else:
+            chat_cache[cache_key] = {"answer": "".join(tokens), **event}
+        yield event
+
+async def replay_cached_answer(result: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """Replay a cached answer in the streaming event format"""
+    yield {"token": result["answer"]}
+    yield {key: value for key, value in result.items() if key != "answer"}
+
+async def sse_wrap(events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Format events as Server-Sent Events; errors after the stream started become an error event"""
+    try:
+        async for event in events:
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+    except Exception as e:
+        logger.exception("Error in chat stream")
+        yield b"data: " + orjson.dumps({"error": f"Error processing message: {str(e)}"}) + b"\n\n"
+
+@router.get("/status", response_model=StatusResponse)
+async def get_status(request: Request):
+    """Get current status of the RAG bot with detailed information"""
+    
+    services = get_current_services()
+    document_processor, retrieval_service = services
+    
+    def build_status():
+        # Get document stats
+        doc_stats = document_processor.get_document_stats()
+        retrieval_status = retrieval_service.get_status()
+        
+        document_names = [doc["filename"] for doc in doc_stats["documents"]]
+        
+        return StatusResponse(
+            documents_uploaded=doc_stats["total_documents"],
+            documents=document_names,
+            ready_for_chat=retrieval_status["ready_for_queries"]
+        )
+    
+    return cached_json_response(request, services, build_status)
+
 @router.delete("/reset")
-async def reset_bot(services: tuple = Depends(get_user_services)):
+async def reset_bot():
     """Reset the bot by clearing all uploaded documents"""
     
-    document_processor, retrieval_service = services
+    document_processor, retrieval_service = get_current_services()
     
     # Reset both services
     document_processor.clear_documents()
-    retrieval_service.reset()
+    await retrieval_service.reset()
+    await persist_current_session()
     
     return {"message": "Bot reset successfully. All documents cleared."}
 
 @router.get("/documents/stats")
-async def get_document_stats(services: tuple = Depends(get_user_services)):
+async def get_document_stats(request: Request):
     """Get detailed statistics about uploaded documents"""
     
+    services = get_current_services()
     document_processor, retrieval_service = services
     
-    doc_stats = document_processor.get_document_stats()
-    retrieval_status = retrieval_service.get_status()
+    def build_stats():
+        doc_stats = document_processor.get_document_stats()
+        retrieval_status = retrieval_service.get_status()
+        
+        return {
+            **doc_stats,
+            **retrieval_status
+        }
     
-    return {
-        **doc_stats,
-        **retrieval_status
-    }
+    return cached_json_response(request, services, build_stats)
 
 @router.get("/documents", response_model=List[DocumentWithId])
-async def get_documents(services: tuple = Depends(get_user_services)):
+async def get_documents(request: Request):
     """Get list of uploaded documents with their IDs"""
     
+    services = get_current_services()
     document_processor, retrieval_service = services
     
-    doc_stats = document_processor.get_document_stats()
-    return [
-        DocumentWithId(**doc) for doc in doc_stats["documents"]
-    ]
+    def build_documents():
+        # The slim document dicts already match DocumentWithId, so they are encoded as-is
+        return document_processor.get_document_stats()["documents"]
+    
+    return cached_json_response(request, services, build_documents)
 
 @router.delete("/documents/{document_id}", response_model=DeleteResponse)
-async def delete_document(document_id: int, services: tuple = Depends(get_user_services)):
-    """Delete a specific document by its ID and rebuild the vector store"""
+async def delete_document(document_id: int):
+    """Delete a specific document by its ID and drop its chunks from the vector store"""
     
-    document_processor, retrieval_service = services
+    document_processor, retrieval_service = get_current_services()
     
     try:
         # Check if document exists
@@ -142,11 +480,10 @@ async def delete_document(document_id: int, services: tuple = Depends(get_user_s
         if not deleted:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        # Get remaining documents
-        remaining_texts, remaining_names = document_processor.get_remaining_texts_and_names()
-        
-        # Rebuild vector store with remaining documents
-        retrieval_service.rebuild_vector_store_without_document(remaining_texts, remaining_names)
+        # Remove only the deleted document's vectors; the others keep their embeddings
+        await retrieval_service.remove_document(document_id)
+        remaining_names = document_processor.get_remaining_document_names()
+        await persist_current_session()
         
         return DeleteResponse(
             message=f"Document '{doc_to_delete['filename']}' deleted successfully",
@@ -157,5 +494,5 @@ async def delete_document(document_id: int, services: tuple = Depends(get_user_s
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error deleting document: {str(e)}")
+        logger.exception("Error deleting document")
         raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
\ No newline at end of file
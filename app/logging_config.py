@@ -0,0 +1,36 @@
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Optional rotating log file; records always go to stderr as well
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+_listener: Optional[QueueListener] = None
+
+def configure_logging() -> QueueListener:
+    """Route all log records through a queue drained by a background thread"""
+    global _listener
+    if _listener is not None:
+        return _listener
+    
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    # Request handlers only enqueue records; formatting and I/O happen on the listener thread
+    _listener = QueueListener(queue.Queue(-1), *handlers, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.handlers = [QueueHandler(_listener.queue)]
+    root_logger.setLevel(LOG_LEVEL)
+    
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,34 +1,62 @@
 import os
+import sys
 import uuid
 from fastapi import FastAPI, Request, Depends
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from starlette.middleware.sessions import SessionMiddleware
-from app.api.routes import router
+from app.logging_config import configure_logging
+from app.api.routes import router, warm_user_services, SessionServicesMiddleware
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+configure_logging()
+
+# Comma-separated origins allowed to call the API with credentials
+FRONTEND_URLS = [url.strip() for url in os.getenv("FRONTEND_URL", "http://localhost:8000").split(",") if url.strip()]
+
 # Create FastAPI app
 app = FastAPI(
     title="RAG Bot - Enhanced Multi-Document Q&A",
     description="A sophisticated RAG bot with multi-PDF support and modular architecture",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# Bind each API request's session services once (added first so it runs inside the session middleware)
+app.add_middleware(SessionServicesMiddleware, path_prefix="/api")
+
 # Add session middleware (add this before CORS middleware)
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key-change-this-in-production")
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=FRONTEND_URLS,  # Browsers reject "*" together with credentials
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZip middleware that leaves streaming endpoints alone, since gzip would hold tokens back"""
+    
+    def __init__(self, app, exclude_paths: tuple = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self.exclude_paths = set(exclude_paths)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Compress larger JSON payloads (chat answers, document stats)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=5, exclude_paths=("/api/chat/stream",))
+
 # Mount static files and templates
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
@@ -44,8 +72,9 @@ app.include_router(router, prefix="/api", tags=["RAG Bot"])
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    # Ensure user has a session ID
-    get_session_id(request)
+    # Ensure user has a session ID and its services are ready before the first API call
+    session_id = get_session_id(request)
+    await warm_user_services(session_id)
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.get("/health")
@@ -54,4 +83,11 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # Run with uvloop + httptools; reload needs an import string, so use the root main.py for that
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
+    )
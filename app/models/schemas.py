@@ -1,19 +1,28 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from pydantic.dataclasses import dataclass
 from typing import List, Optional
 
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+    
     message: str
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
     response: str
     source_documents: Optional[List[str]] = []
 
 class UploadResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
     message: str
     documents: List[str]
     total_documents: int
 
 class StatusResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
     documents_uploaded: int
     documents: List[str]
     ready_for_chat: bool
@@ -24,7 +33,9 @@ class DocumentInfo(BaseModel):
     text_length: int
     upload_time: str
 
-class DocumentWithId(BaseModel):
+# No validators or model behaviour needed, so a pydantic dataclass keeps construction cheap
+@dataclass(frozen=True)
+class DocumentWithId:
     id: int
     filename: str
     page_count: int
@@ -33,6 +44,8 @@ class DocumentWithId(BaseModel):
     size: int
 
 class DeleteResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
     message: str
     remaining_documents: List[str]
     total_remaining: int
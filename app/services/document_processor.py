@@ -1,133 +1,359 @@
+import asyncio
+import logging
+import mmap
+import multiprocessing
 import os
+import shutil
+import stat
 import tempfile
-from typing import List, Dict, Any
-import PyPDF2
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from typing import List, Dict, Any, AsyncIterator, BinaryIO, Iterator, Optional
+import pypdfium2 as pdfium
 from datetime import datetime
 from fastapi import HTTPException, UploadFile
 
-class Document:
-    """Simple Document class for compatibility"""
-    def __init__(self, page_content: str, metadata: dict = None):
-        self.page_content = page_content
-        self.metadata = metadata or {}
+logger = logging.getLogger(__name__)
+
+# Uploads are copied to disk in 1 MiB pieces so a request body is never held in memory whole
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Shared sessions keep their extracted text and vector index here; text is mapped back in on demand
+TEXT_STORE_DIR = os.getenv("RAGBOT_TEXT_DIR", os.path.join(tempfile.gettempdir(), "ragbot"))
+
+# Every PDF starts with this signature within its first KiB
+PDF_MAGIC = b"%PDF-"
+PDF_HEADER_WINDOW = 1024
+
+# Keys of a document's info that stay server-side
+PRIVATE_DOCUMENT_FIELDS = {"text_path"}
+
+def create_pool() -> ProcessPoolExecutor:
+    """Worker pool for PDF parsing, which is CPU-bound and must stay off the event loop"""
+    # Forkserver workers start from a clean interpreter instead of a fork of this threaded one
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+
+_pool = create_pool()
+
+def replace_broken_pool(broken_pool: ProcessPoolExecutor):
+    """Swap in a fresh worker pool after a worker died, unless another upload already did"""
+    global _pool
+    if _pool is broken_pool:
+        _pool = create_pool()
+        broken_pool.shutdown(wait=False)
+
+def extract_text_from_pdf_path(file_path: str) -> tuple[str, int]:
+    """Extract text and page count from a PDF file (runs inside a pool worker)"""
+    # Open the file ourselves: PDFium resolves a /proc/<pid>/fd path to the deleted inode's name and fails
+    with open(file_path, "rb") as pdf_file:
+        pdf = pdfium.PdfDocument(pdf_file)
+        try:
+            page_count = len(pdf)
+            parts = []
+            
+            for page_num in range(page_count):
+                page = pdf[page_num]
+                textpage = page.get_textpage()
+                # PDFium reports line breaks as CRLF; keep the LF-only text the splitter expects
+                page_text = textpage.get_text_range().replace("\r\n", "\n")
+                textpage.close()
+                page.close()
+                # Add page separator for multi-page documents; the page text is appended
+                # as its own piece so it is copied only once, by the final join
+                parts.append(f"\n--- Page {page_num + 1} ---\n")
+                parts.append(page_text)
+                parts.append("\n")
+        finally:
+            pdf.close()
+    
+    return "".join(parts), page_count
+
+@contextmanager
+def anon_tmp() -> Iterator[tuple[BinaryIO, str]]:
+    """Yield an anonymous temporary file and a path pool workers can open it by"""
+    fd = None
+    if hasattr(os, "O_TMPFILE"):
+        try:
+            # Linux: the inode has no directory entry and is freed when the fd closes,
+            # so nothing is left behind even if the worker dies mid-upload
+            fd = os.open(tempfile.gettempdir(), os.O_TMPFILE | os.O_RDWR, 0o600)
+        except OSError:
+            # Filesystem without O_TMPFILE support
+            fd = None
+    
+    if fd is not None:
+        with os.fdopen(fd, 'w+b') as tmp_file:
+            yield tmp_file, f"/proc/{os.getpid()}/fd/{fd}"
+        return
+    
+    # Other platforms: fall back to a named temporary file removed on exit
+    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+    try:
+        with tmp_file:
+            yield tmp_file, tmp_file.name
+    finally:
+        os.unlink(tmp_file.name)
+
+def is_private_directory(path: str) -> bool:
+    """Whether path is a real directory that no other user can write to"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    # Windows has no POSIX owners or mode bits to check
+    if not hasattr(os, "getuid"):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def is_private_text_path(path: str) -> bool:
+    """Whether path and every directory above it up to TEXT_STORE_DIR are private to this user"""
+    root = os.path.abspath(TEXT_STORE_DIR)
+    path = os.path.abspath(path)
+    while is_private_directory(path):
+        if path == root:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return False
 
 class DocumentProcessor:
     """Handles PDF document processing and text extraction"""
     
-    def __init__(self):
-        self.uploaded_documents: List[Dict[str, Any]] = []
+    def __init__(self, text_dir: Optional[str] = None):
+        # Documents keyed by ID; dicts keep insertion order, so this doubles as the upload-ordered list
+        self._by_id: Dict[int, Dict[str, Any]] = {}
         self.document_id_counter = 0
+        # Extracted text is only written to disk when a shared directory lets other workers restore the session
+        self._text_dir = text_dir
+        # Running totals so statistics never need to rescan the document list
+        self._total_pages = 0
+        self._total_text_length = 0
+        # Bumped on every change to the document set; used to validate cached responses
+        self._cache_version = 0
+    
+    @property
+    def uploaded_documents(self) -> List[Dict[str, Any]]:
+        """Uploaded documents in upload order"""
+        return list(self._by_id.values())
+    
+    @property
+    def cache_version(self) -> int:
+        """Version of the document set, incremented whenever it changes"""
+        return self._cache_version
     
     async def process_uploaded_files(self, files: List[UploadFile]) -> tuple[List[str], List[Dict[str, Any]]]:
         """Process multiple uploaded PDF files and extract text"""
         if not files:
             raise HTTPException(status_code=400, detail="No files uploaded")
         
+        for file in files:
+            self.validate_filename(file.filename)
+        
+        # Read, spool and extract every file concurrently; the semaphore caps how many
+        # PDFs are being parsed (and held as extracted text) at the same time
+        semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+        results = await asyncio.gather(*[
+            self._process_one(file.filename, self._iter_upload_file(file), semaphore) for file in files
+        ])
+        
         texts = []
         document_info = []
         
-        for file in files:
-            if not file.filename.endswith('.pdf'):
-                raise HTTPException(status_code=400, detail=f"File {file.filename} is not a PDF. Only PDF files are supported")
-            
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                content = await file.read()
-                tmp_file.write(content)
-                tmp_file_path = tmp_file.name
-            
-            try:
-                # Extract text from PDF
-                text, page_count = self.extract_text_from_pdf(tmp_file_path)
-                texts.append(text)
-                
-                # Store document information with unique ID and text
-                self.document_id_counter += 1
-                doc_info = {
-                    "id": self.document_id_counter,
-                    "filename": file.filename,
-                    "page_count": page_count,
-                    "text_length": len(text),
-                    "upload_time": datetime.now().isoformat(),
-                    "size": len(content),
-                    "text": text  # Store the extracted text for rebuilding
-                }
-                document_info.append(doc_info)
-                self.uploaded_documents.append(doc_info)
-                
-            finally:
-                # Clean up temporary file
-                os.unlink(tmp_file_path)
+        # Register in upload order so document IDs stay deterministic
+        for file, (text, page_count, size) in zip(files, results):
+            texts.append(text)
+            document_info.append(self._register_document(file.filename, text, page_count, size))
         
         if not texts:
             raise HTTPException(status_code=400, detail="No text could be extracted from the uploaded files")
         
         return texts, document_info
     
-    def extract_text_from_pdf(self, file_path: str) -> tuple[str, int]:
-        """Extract text from PDF file and return text with page count"""
-        text = ""
-        page_count = 0
+    async def process_stream(self, filename: str, chunks: AsyncIterator[bytes]) -> tuple[str, Dict[str, Any]]:
+        """Spool a PDF byte stream to a temporary file, extract its text and register it"""
+        text, page_count, size = await self._process_one(filename, chunks)
+        return text, self._register_document(filename, text, page_count, size)
+    
+    async def _process_one(self, filename: str, chunks: AsyncIterator[bytes], semaphore: Optional[asyncio.Semaphore] = None) -> tuple[str, int, int]:
+        """Spool one PDF to an anonymous temporary file and extract it; returns text, page count and size"""
+        with anon_tmp() as (tmp_file, tmp_file_path):
+            size = await self._spool_to_file(filename, chunks, tmp_file)
+            async with semaphore or nullcontext():
+                text, page_count = await self.extract_text_from_pdf_async(tmp_file_path)
         
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                page_count = len(pdf_reader.pages)
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    # Add page separator for multi-page documents
-                    text += f"\n--- Page {page_num + 1} ---\n{page_text}\n"
-                    
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error reading PDF: {str(e)}")
+        return text, page_count, size
+    
+    def _register_document(self, filename: str, text: str, page_count: int, size: int) -> Dict[str, Any]:
+        """Store document information with unique ID and text"""
+        self.document_id_counter += 1
+        doc_info = {
+            "id": self.document_id_counter,
+            "filename": filename,
+            "page_count": page_count,
+            "text_length": len(text),
+            "upload_time": datetime.now().isoformat(),
+            "size": size
+        }
+        if self._text_dir is not None:
+            # Extracted text kept for restoring the session elsewhere
+            doc_info["text_path"] = self._store_text(self.document_id_counter, text)
+        self._by_id[doc_info["id"]] = doc_info
+        self._total_pages += page_count
+        self._total_text_length += doc_info["text_length"]
+        self._cache_version += 1
+        return doc_info
+    
+    def restore_documents(self, documents: List[Dict[str, Any]], document_id_counter: int):
+        """Re-register documents persisted by another worker, skipping any whose text file is gone"""
+        for doc in documents:
+            if not os.path.exists(doc["text_path"]):
+                continue
+            self._by_id[doc["id"]] = doc
+            self._total_pages += doc["page_count"]
+            self._total_text_length += doc["text_length"]
+        
+        self.document_id_counter = max(self.document_id_counter, document_id_counter)
+        self._cache_version += 1
+    
+    def _store_text(self, document_id: int, text: str) -> str:
+        """Write extracted text to the shared text directory and return its path"""
+        # Owner-only, so other users on the host can neither read session text nor plant files in it
+        os.makedirs(TEXT_STORE_DIR, mode=0o700, exist_ok=True)
+        os.makedirs(self._text_dir, mode=0o700, exist_ok=True)
         
-        return text, page_count
+        text_path = os.path.join(self._text_dir, f"{document_id}.txt")
+        fd = os.open(text_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w', encoding='utf-8') as text_file:
+            text_file.write(text)
+        return text_path
+    
+    @staticmethod
+    def read_document_text(doc: Dict[str, Any]) -> str:
+        """Load a document's extracted text through a read-only memory map"""
+        with open(doc["text_path"], 'rb') as text_file:
+            if os.fstat(text_file.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(text_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Decode straight from the page cache without an intermediate bytes copy
+                return str(mapped, 'utf-8')
+    
+    @staticmethod
+    async def _spool_to_file(filename: str, chunks: AsyncIterator[bytes], tmp_file: BinaryIO) -> int:
+        """Write a PDF byte stream to an open temporary file, one chunk at a time, and return its size"""
+        size = 0
+        # Nothing is written until the first bytes have been checked for the PDF signature
+        header = b""
+        
+        async for chunk in chunks:
+            if header is not None:
+                header += chunk
+                if len(header) < PDF_HEADER_WINDOW:
+                    continue
+                DocumentProcessor.validate_pdf_header(filename, header)
+                chunk, header = header, None
+            tmp_file.write(chunk)
+            size += len(chunk)
+        
+        # Streams shorter than the header window
+        if header is not None:
+            DocumentProcessor.validate_pdf_header(filename, header)
+            tmp_file.write(header)
+            size += len(header)
+        
+        # Make the bytes visible to the pool worker that reopens the file
+        tmp_file.flush()
+        return size
+    
+    @staticmethod
+    def validate_pdf_header(filename: str, header: bytes):
+        """Reject payloads without a PDF signature before any of them is written or parsed"""
+        # Like most readers, accept the signature anywhere in the first KiB
+        if PDF_MAGIC not in header[:PDF_HEADER_WINDOW]:
+            raise HTTPException(status_code=400, detail=f"File {filename} is not a valid PDF document")
+    
+    @staticmethod
+    def validate_filename(filename: str):
+        """Reject files that do not carry a .pdf extension"""
+        if not filename or not filename.endswith('.pdf'):
+            raise HTTPException(status_code=400, detail=f"File {filename} is not a PDF. Only PDF files are supported")
+    
+    @staticmethod
+    async def _iter_upload_file(file: UploadFile) -> AsyncIterator[bytes]:
+        """Yield the body of an uploaded file in fixed-size chunks"""
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+    
+    async def extract_text_from_pdf_async(self, file_path: str) -> tuple[str, int]:
+        """Extract text from PDF file in the process pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = _pool
+            try:
+                return await loop.run_in_executor(pool, extract_text_from_pdf_path, file_path)
+            except BrokenProcessPool as e:
+                # A worker died, failing every file in flight; retry once on a fresh pool so
+                # only a file that crashes the worker again is rejected
+                replace_broken_pool(pool)
+                if attempt:
+                    raise HTTPException(status_code=400, detail=f"Error reading PDF: {str(e)}")
+                logger.warning("PDF worker pool broke, retrying extraction on a new pool")
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error reading PDF: {str(e)}")
     
     def get_document_stats(self) -> Dict[str, Any]:
         """Get statistics about uploaded documents"""
-        total_pages = sum(doc["page_count"] for doc in self.uploaded_documents)
-        total_text_length = sum(doc["text_length"] for doc in self.uploaded_documents)
-        
         return {
-            "total_documents": len(self.uploaded_documents),
-            "total_pages": total_pages,
-            "total_text_length": total_text_length,
-            "documents": self.uploaded_documents
+            "total_documents": len(self._by_id),
+            "total_pages": self._total_pages,
+            "total_text_length": self._total_text_length,
+            # Internal storage details are not part of the public document info
+            "documents": [
+                {key: value for key, value in doc.items() if key not in PRIVATE_DOCUMENT_FIELDS}
+                for doc in self._by_id.values()
+            ]
         }
     
     def clear_documents(self):
         """Clear all uploaded documents"""
-        self.uploaded_documents.clear()
+        self._by_id.clear()
+        self._total_pages = 0
+        self._total_text_length = 0
+        self._cache_version += 1
+        if self._text_dir is not None:
+            shutil.rmtree(self._text_dir, ignore_errors=True)
     
     def delete_document(self, document_id: int) -> bool:
         """Delete a specific document by ID"""
-        for i, doc in enumerate(self.uploaded_documents):
-            if doc["id"] == document_id:
-                deleted_doc = self.uploaded_documents.pop(i)
-                print(f"Deleted document: {deleted_doc['filename']}")
-                return True
-        return False
+        deleted_doc = self._by_id.pop(document_id, None)
+        if deleted_doc is None:
+            return False
+        
+        self._total_pages -= deleted_doc["page_count"]
+        self._total_text_length -= deleted_doc["text_length"]
+        self._cache_version += 1
+        text_path = deleted_doc.get("text_path")
+        if text_path and os.path.exists(text_path):
+            os.unlink(text_path)
+        logger.info("Deleted document: %s", deleted_doc["filename"])
+        return True
     
     def get_document_by_id(self, document_id: int) -> Dict[str, Any]:
         """Get document information by ID"""
-        for doc in self.uploaded_documents:
-            if doc["id"] == document_id:
-                return doc
-        return None
+        return self._by_id.get(document_id)
     
     def get_remaining_document_names(self) -> List[str]:
         """Get list of remaining document filenames"""
-        return [doc["filename"] for doc in self.uploaded_documents]
-    
-    def get_remaining_texts_and_names(self) -> tuple[List[str], List[str]]:
-        """Get remaining document texts and names after deletion"""
-        texts = [doc["text"] for doc in self.uploaded_documents]
-        names = [doc["filename"] for doc in self.uploaded_documents]
-        return texts, names
+        return [doc["filename"] for doc in self._by_id.values()]
     
-    def get_remaining_texts_and_names_for_rebuilding(self) -> tuple[List[str], List[str]]:
-        """Get remaining document texts and names for vector store rebuilding"""
-        texts = [doc["text"] for doc in self.uploaded_documents]
-        names = [doc["filename"] for doc in self.uploaded_documents]
+    def get_remaining_texts_and_names(self) -> tuple[Iterator[str], List[str]]:
+        """Get remaining document texts (loaded lazily, one at a time) and names after deletion"""
+        documents = self.uploaded_documents
+        texts = (self.read_document_text(doc) for doc in documents)
+        names = [doc["filename"] for doc in documents]
         return texts, names
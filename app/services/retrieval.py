@@ -1,180 +1,466 @@
+import asyncio
+import itertools
+import logging
+import math
 import os
-import traceback
-from typing import List, Dict, Any
-from langchain.text_splitter import CharacterTextSplitter
+import uuid
+from functools import lru_cache
+from typing import List, Dict, Any, AsyncIterator, Iterable, Optional
+import faiss
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.prompts import format_document
 from dotenv import load_dotenv
 from fastapi import HTTPException
-
-from .document_processor import Document
+from .document_processor import is_private_text_path
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Read once at import; a missing key surfaces as an authentication error on the first OpenAI call
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# "huggingface" embeds locally with a sentence-transformers model; "openai" uses the remote API
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "huggingface").lower()
+
+# Chunks per embeddings request; 500 chunks of at most 600 tokens stay within OpenAI's per-request token cap
+EMBEDDING_BATCH_SIZE = 500
+# Embedding requests allowed in flight at once for one upload; a local model already uses every core
+# (or the GPU) for one batch, so parallel batches would only contend for it
+EMBEDDING_CONCURRENCY = 5 if EMBEDDING_PROVIDER == "openai" else 1
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_BATCH_SIZE = 128
+
+# Chunk sizes in tokens of the embedding model's tokenizer; the local MiniLM model truncates its input at 256 word pieces
+CHUNK_TOKENS = 600 if EMBEDDING_PROVIDER == "openai" else 250
+CHUNK_OVERLAP_TOKENS = CHUNK_TOKENS // 6
+
+# Questions whose embeddings are at least this similar reuse a previous answer
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# MMR picks 5 diverse chunks out of the 20 nearest, so the prompt isn't filled with near-duplicates
+RETRIEVAL_SEARCH_KWARGS = {"k": 5, "fetch_k": 20, "lambda_mult": 0.5}
+
+# FAISS ids are (document_id << CHUNK_ID_BITS) | chunk index, so a document's chunks can be removed by id
+CHUNK_ID_BITS = 20
+
+# IVF-PQ parameters for large corpora; smaller ones use an 8-bit scalar-quantized flat index
+IVF_MIN_LISTS = 64
+IVF_NPROBE = 10
+IVF_TRAINING_POINTS_PER_CENTROID = 39  # FAISS' recommended minimum
+PQ_SUBQUANTIZERS = 64
+PQ_BITS = 8
+
+# Chunk and question vectors are normalized before they reach FAISS, so inner product is cosine similarity
+VECTOR_STORE_OPTIONS = {"distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT}
+
+# GPU builds of FAISS expose StandardGpuResources; CPU-only builds report no GPUs
+FAISS_GPU_AVAILABLE = hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+@lru_cache(maxsize=None)
+def get_embeddings() -> Embeddings:
+    """Embedding model shared by every session; the local model is loaded once per process"""
+    if EMBEDDING_PROVIDER == "openai":
+        # Chunks are sent in large batches per request
+        return OpenAIEmbeddings(
+            openai_api_key=OPENAI_API_KEY,
+            chunk_size=EMBEDDING_BATCH_SIZE,
+            show_progress_bar=False
+        )
+    
+    import torch
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    logger.info("Loading local embedding model %s on %s", LOCAL_EMBEDDING_MODEL, device)
+    return HuggingFaceEmbeddings(
+        model_name=LOCAL_EMBEDDING_MODEL,
+        model_kwargs={"device": device},
+        encode_kwargs={"batch_size": LOCAL_EMBEDDING_BATCH_SIZE, "normalize_embeddings": True}
+    )
+
+@lru_cache(maxsize=None)
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    """Splitter shared by every session, so its tokenizer is loaded once per process"""
+    # Chunk lengths are counted with the embedding model's own tokenizer, so a chunk never exceeds its input window
+    separators = ["\n\n", "\n", ". ", " "]
+    if EMBEDDING_PROVIDER == "openai":
+        return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            model_name="text-embedding-ada-002",
+            chunk_size=CHUNK_TOKENS,
+            chunk_overlap=CHUNK_OVERLAP_TOKENS,
+            separators=separators,
+        )
+    
+    from transformers import AutoTokenizer
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        AutoTokenizer.from_pretrained(LOCAL_EMBEDDING_MODEL),
+        chunk_size=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
+        separators=separators,
+    )
+
+@lru_cache(maxsize=None)
+def get_llm() -> ChatOpenAI:
+    """Chat model shared by every session, so its HTTP connection pool is reused"""
+    return ChatOpenAI(
+        model="gpt-3.5-turbo",
+        temperature=0.7,
+        openai_api_key=OPENAI_API_KEY,
+        streaming=True
+    )
+
 class RetrievalService:
     """Handles vector store creation and question answering"""
     
-    def __init__(self):
+    def __init__(self, index_path: Optional[str] = None):
+        self.index_path = index_path
         self.vector_store = None
-        self.qa_chain = None
         self.document_count = 0
+        self._embeddings = get_embeddings()
+        self._llm = get_llm()
+        # "Stuff" chain that answers from retrieved chunks; it holds no store, so one serves the service's lifetime.
+        # Verbose chains print whole prompts, document text included, to stdout
+        self.qa_chain = load_qa_chain(self._llm, chain_type="stuff", verbose=logger.isEnabledFor(logging.DEBUG))
+        self._splitter = get_text_splitter()
+        self._query_cache: List[tuple[np.ndarray, Dict[str, Any]]] = []
+        # Serializes changes to the vector store; index updates run in executor threads
+        self._lock = asyncio.Lock()
+        
+    @staticmethod
+    def ivf_list_count(num_vectors: int, dimension: int) -> Optional[int]:
+        """Number of IVF lists for a corpus of this size, or None when it is too small to train IVF-PQ on"""
+        nlist = max(IVF_MIN_LISTS, int(4 * math.sqrt(num_vectors)))
+        
+        # IVF and PQ codebooks need enough training points per centroid to be meaningful
+        min_training_points = IVF_TRAINING_POINTS_PER_CENTROID * max(nlist, 2 ** PQ_BITS)
+        if num_vectors < min_training_points or dimension % PQ_SUBQUANTIZERS != 0:
+            return None
+        return nlist
+    
+    @classmethod
+    def build_index(cls, vectors: np.ndarray) -> faiss.Index:
+        """Choose a FAISS index for the given vectors: int8 scalar quantization for small corpora, IVF-PQ for large ones"""
+        num_vectors, dimension = vectors.shape
+        nlist = cls.ivf_list_count(num_vectors, dimension)
+        
+        if nlist is None:
+            # One byte per dimension instead of four. Vectors are unit length, so every component lies
+            # in [-1, 1]; training on those bounds keeps the range valid for documents added later
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            bounds = np.ones((2, dimension), dtype="float32")
+            bounds[1] = -1
+            index.train(bounds)
+            # Flat indexes only number vectors by position; the ID map lets them take chunk ids
+            return faiss.IndexIDMap2(index)
+        
+        logger.info("Training IVF-PQ index (nlist=%d) on %d vectors", nlist, num_vectors)
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, PQ_SUBQUANTIZERS, PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+        if FAISS_GPU_AVAILABLE:
+            # k-means training dominates the build; the trained index itself stays on the CPU.
+            # SWIG setattr disowns the assigned index, so keep our own reference and detach it
+            # after training, letting it and its GPU resources be freed with this frame
+            clustering_index = faiss.index_cpu_to_all_gpus(faiss.IndexFlatIP(dimension))
+            index.clustering_index = clustering_index
+            try:
+                index.train(vectors)
+            finally:
+                index.clustering_index = None
+        else:
+            index.train(vectors)
+        index.nprobe = IVF_NPROBE
+        # MMR re-ranking reconstructs candidate vectors by chunk id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+    
+    @staticmethod
+    async def embed_documents_concurrently(embeddings: Embeddings, chunks: List[str]) -> np.ndarray:
+        """Embed chunks in batches, with a bounded number of embedding requests in flight at once"""
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await embeddings.aembed_documents(batch)
         
-    def create_vector_store(self, texts: List[str], document_names: List[str]) -> FAISS:
-        """Create FAISS vector store from texts with improved chunking"""
+        batches = [chunks[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(chunks), EMBEDDING_BATCH_SIZE)]
+        embedded_batches = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+        return np.asarray([vector for batch in embedded_batches for vector in batch], dtype="float32")
+    
+    def index_vectors(self, vectors: np.ndarray, ids: np.ndarray, index: Optional[faiss.Index] = None) -> faiss.Index:
+        """Add the vectors under the given ids to index, building a new index for them when none is given"""
+        if index is None:
+            index = self.build_index(vectors)
+        elif isinstance(index, faiss.IndexIDMap2) and self.ivf_list_count(index.ntotal + len(vectors), vectors.shape[1]):
+            # The corpus has outgrown the flat index; move the stored vectors and the new ones into IVF-PQ
+            logger.info("Corpus reached %d vectors, switching to IVF-PQ", index.ntotal + len(vectors))
+            stored_vectors = index.index.reconstruct_n(0, index.ntotal)
+            faiss.normalize_L2(stored_vectors)
+            vectors = np.vstack([stored_vectors, vectors])
+            ids = np.concatenate([faiss.vector_to_array(index.id_map), ids])
+            index = self.build_index(vectors)
+        index.add_with_ids(vectors, ids)
+        return index
+    
+    async def create_vector_store(self, texts: Iterable[str], document_names: List[str], document_ids: List[int], existing: Optional[FAISS] = None) -> FAISS:
+        """Create FAISS vector store from texts with improved chunking, or append them to an existing one"""
         try:
-            print(f"Creating vector store from {len(texts)} documents...")
-            
-            # Enhanced text splitter with better parameters
-            text_splitter = CharacterTextSplitter(
-                chunk_size=1500,  # Larger chunks for better context
-                chunk_overlap=300,  # More overlap for continuity
-                separator="\n",
-                length_function=len,
-            )
+            logger.info("Creating vector store from %d documents", len(document_names))
             
             documents = []
+            chunk_ids = []
             for i, text in enumerate(texts):
-                print(f"Processing document {i+1}: {document_names[i] if i < len(document_names) else 'Unknown'}")
-                chunks = text_splitter.split_text(text)
-                print(f"  - Created {len(chunks)} chunks")
+                source = document_names[i] if i < len(document_names) else f"document_{i+1}"
+                chunks = self._splitter.split_text(text)
+                total_chunks = len(chunks)
+                logger.debug("Document %d (%s): %d chunks", i + 1, source, total_chunks)
                 
-                for chunk_idx, chunk in enumerate(chunks):
-                    # Enhanced metadata with more information
-                    metadata = {
-                        "source": document_names[i] if i < len(document_names) else f"document_{i+1}",
-                        "document_id": i,
-                        "chunk_id": chunk_idx,
-                        "total_chunks": len(chunks)
-                    }
-                    documents.append(Document(
-                        page_content=chunk,
-                        metadata=metadata
-                    ))
-            
-            print(f"Total chunks created: {len(documents)}")
-            
-            # Create embeddings with explicit API key
-            embeddings = OpenAIEmbeddings(
-                openai_api_key=os.getenv("OPENAI_API_KEY")
-            )
+                document_id = document_ids[i]
+                documents.extend(
+                    # Must be langchain's Document: the FAISS wrapper rejects anything else found in its docstore
+                    Document(page_content=chunk, metadata={"source": source, "document_id": document_id, "chunk_id": chunk_idx, "total_chunks": total_chunks})
+                    for chunk_idx, chunk in enumerate(chunks)
+                )
+                first_chunk_id = document_id << CHUNK_ID_BITS
+                chunk_ids.extend(range(first_chunk_id, first_chunk_id + total_chunks))
             
-            # Create vector store
-            vector_store = FAISS.from_documents(documents, embeddings)
-            print("Vector store created successfully!")
+            logger.info("Total chunks created: %d", len(documents))
             
-            return vector_store
+            # Embed explicitly so the FAISS index type can be chosen for the corpus size
+            vectors = await self.embed_documents_concurrently(self._embeddings, [doc.page_content for doc in documents])
+            faiss.normalize_L2(vectors)
             
-        except Exception as e:
-            print(f"Error creating vector store: {str(e)}")
-            print(f"Traceback: {traceback.format_exc()}")
-            raise HTTPException(status_code=500, detail=f"Error creating vector store: {str(e)}")
-    
-    def create_qa_chain(self, vector_store: FAISS):
-        """Create QA chain with the vector store"""
-        try:
-            print("Creating QA chain...")
+            # Training and adding vectors is CPU-bound, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            ids = np.asarray(chunk_ids, dtype="int64")
+            index = await loop.run_in_executor(None, self.index_vectors, vectors, ids, existing.index if existing else None)
             
-            llm = ChatOpenAI(
-                model="gpt-3.5-turbo",
-                temperature=0.7,
-                openai_api_key=os.getenv("OPENAI_API_KEY")
-            )
-            
-            # Enhanced retriever with more results
-            retriever = vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 5}  # Get more relevant chunks
-            )
+            # Search results come back as chunk ids, so they key the docstore mapping directly
+            docstore_ids = [str(uuid.uuid4()) for _ in documents]
+            if existing is not None:
+                # Vectors were appended in place (or the index was rebuilt around them), so only the docstore mapping needs extending
+                existing.index = index
+                existing.docstore.add(dict(zip(docstore_ids, documents)))
+                existing.index_to_docstore_id.update(zip(chunk_ids, docstore_ids))
+                logger.debug("Documents added to vector store")
+                return existing
             
-            qa_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=retriever,
-                return_source_documents=True,
-                verbose=True
+            # Create vector store
+            vector_store = FAISS(
+                embedding_function=self._embeddings,
+                index=index,
+                docstore=InMemoryDocstore(dict(zip(docstore_ids, documents))),
+                index_to_docstore_id=dict(zip(chunk_ids, docstore_ids)),
+                **VECTOR_STORE_OPTIONS
             )
+            logger.debug("Vector store created")
             
-            print("QA chain created successfully!")
-            return qa_chain
+            return vector_store
             
         except Exception as e:
-            print(f"Error creating QA chain: {str(e)}")
-            print(f"Traceback: {traceback.format_exc()}")
-            raise HTTPException(status_code=500, detail=f"Error creating QA chain: {str(e)}")
+            logger.exception("Error creating vector store")
+            raise HTTPException(status_code=500, detail=f"Error creating vector store: {str(e)}")
     
-    def add_documents(self, texts: List[str], document_names: List[str]):
+    async def add_documents(self, texts: Iterable[str], document_names: List[str], document_ids: List[int]):
         """Add new documents to existing vector store or create new one"""
         try:
-            if self.vector_store is None:
-                print("Creating new vector store...")
-                self.vector_store = self.create_vector_store(texts, document_names)
-                self.document_count = len(texts)
-            else:
-                print("Adding documents to existing vector store...")
-                # Create new vector store for new documents
-                new_vector_store = self.create_vector_store(texts, document_names)
-                # Merge with existing vector store
-                self.vector_store.merge_from(new_vector_store)
-                self.document_count += len(texts)
-            
-            # Create or update QA chain
-            self.qa_chain = self.create_qa_chain(self.vector_store)
-            
-            print(f"Total documents in vector store: {self.document_count}")
+            async with self._lock:
+                await self._add_documents(texts, document_names, document_ids)
+            logger.info("Total documents in vector store: %d", self.document_count)
             
         except Exception as e:
-            print(f"Error adding documents: {str(e)}")
+            logger.exception("Error adding documents")
             raise HTTPException(status_code=500, detail=f"Error adding documents: {str(e)}")
     
-    def query(self, question: str) -> Dict[str, Any]:
-        """Query the documents and return answer with sources"""
-        if self.qa_chain is None:
+    async def _add_documents(self, texts: Iterable[str], document_names: List[str], document_ids: List[int]):
+        """Add documents to the vector store; the caller holds self._lock"""
+        if self.vector_store is None:
+            self.vector_store = await self.create_vector_store(texts, document_names, document_ids)
+            self.document_count = len(document_names)
+        else:
+            # Embed only the new documents and append them to the current index
+            await self.create_vector_store(texts, document_names, document_ids, existing=self.vector_store)
+            self.document_count += len(document_names)
+        
+        # Earlier answers may not reflect the new documents
+        self._query_cache.clear()
+        await self._save()
+    
+    async def _save(self):
+        """Write the vector store to index_path, so a restart or another worker can load it without re-embedding; the caller holds self._lock"""
+        if self.index_path is None or self.vector_store is None:
+            return
+        # Created owner-only, since load() refuses to unpickle from a directory others could write to
+        os.makedirs(self.index_path, mode=0o700, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.vector_store.save_local, self.index_path)
+    
+    def load(self, document_count: int) -> bool:
+        """Load the vector store saved at index_path; returns False when there is none"""
+        if self.index_path is None or not os.path.exists(os.path.join(self.index_path, "index.faiss")):
+            return False
+        # load_local unpickles the docstore, so a file planted by another user would run as this process
+        if not is_private_text_path(self.index_path):
+            logger.warning("Not loading vector store from %s: it is writable by other users", self.index_path)
+            return False
+        
+        logger.info("Loading saved vector store from %s", self.index_path)
+        self.vector_store = FAISS.load_local(self.index_path, self._embeddings, **VECTOR_STORE_OPTIONS)
+        self.document_count = document_count
+        self._query_cache.clear()
+        return True
+    
+    def ensure_ready(self):
+        """Raise a client error when there is nothing to query yet"""
+        if self.vector_store is None:
             raise HTTPException(status_code=400, detail="No documents uploaded yet. Please upload PDF documents first.")
+    
+    async def query(self, question: str) -> Dict[str, Any]:
+        """Query the documents and return answer with sources"""
+        self.ensure_ready()
         
         try:
-            print(f"Processing query: {question}")
+            logger.debug("Processing query: %s", question)
+            
+            question_vector = await self._embed_question(question)
+            cached = self._lookup_similar_answer(question_vector)
+            if cached is not None:
+                logger.debug("Answered from semantic query cache")
+                return cached
             
-            # Get response from QA chain
-            result = self.qa_chain({"query": question})
+            # Retrieve by the question's embedding, then answer from the chunks with the stuff chain
+            source_documents = await self._retrieve(question_vector)
+            result = await self.qa_chain.ainvoke({"input_documents": source_documents, "question": question})
             
             # Extract and process source information
-            source_docs = []
-            source_info = []
-            
-            if "source_documents" in result:
-                for doc in result["source_documents"]:
-                    source_name = doc.metadata.get("source", "Unknown")
-                    chunk_info = f"Chunk {doc.metadata.get('chunk_id', 0) + 1}/{doc.metadata.get('total_chunks', 1)}"
-                    
-                    if source_name not in source_docs:
-                        source_docs.append(source_name)
-                    
-                    source_info.append({
-                        "source": source_name,
-                        "chunk_info": chunk_info,
-                        "preview": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-                    })
-            
-            print(f"Query processed successfully. Found {len(source_docs)} source documents.")
-            
-            return {
-                "answer": result["result"],
+            source_docs, source_info = self._summarize_sources(source_documents)
+            
+            logger.debug("Query answered from %d source documents", len(source_docs))
+            
+            response = {
+                "answer": result[self.qa_chain.output_key],
                 "sources": source_docs,
                 "source_details": source_info,
                 "total_documents_searched": self.document_count
             }
+            self._remember_answer(question_vector, response)
+            return response
             
+        except HTTPException:
+            raise
         except Exception as e:
-            print(f"Error processing query: {str(e)}")
+            logger.exception("Error processing query")
             raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
     
-    def reset(self):
+    async def astream_query(self, question: str) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the answer token by token, then the sources it was based on"""
+        self.ensure_ready()
+        
+        logger.debug("Streaming query: %s", question)
+        
+        question_vector = await self._embed_question(question)
+        cached = self._lookup_similar_answer(question_vector)
+        if cached is not None:
+            logger.debug("Answered from semantic query cache")
+            yield {"token": cached["answer"]}
+            yield {key: value for key, value in cached.items() if key != "answer"}
+            return
+        
+        # Same retrieval and "stuff" prompt as query(), but the LLM call is streamed
+        source_documents = await self._retrieve(question_vector)
+        stuff_chain = self.qa_chain
+        context = stuff_chain.document_separator.join(
+            format_document(doc, stuff_chain.document_prompt) for doc in source_documents
+        )
+        prompt = stuff_chain.llm_chain.prompt.format_prompt(
+            **{stuff_chain.document_variable_name: context, "question": question}
+        )
+        
+        tokens = []
+        async for chunk in stuff_chain.llm_chain.llm.astream(prompt):
+            if chunk.content:
+                tokens.append(chunk.content)
+                yield {"token": chunk.content}
+        
+        source_docs, source_info = self._summarize_sources(source_documents)
+        sources = {
+            "sources": source_docs,
+            "source_details": source_info,
+            "total_documents_searched": self.document_count
+        }
+        self._remember_answer(question_vector, {"answer": "".join(tokens), **sources})
+        yield sources
+    
+    async def _retrieve(self, question_vector: np.ndarray) -> List[Document]:
+        """Chunks to answer from, searched by an already computed question embedding"""
+        # Held so the search never reads the index while an add or remove is changing it
+        async with self._lock:
+            if self.vector_store is None:
+                raise HTTPException(status_code=400, detail="No documents uploaded yet. Please upload PDF documents first.")
+            return await self.vector_store.amax_marginal_relevance_search_by_vector(question_vector.tolist(), **RETRIEVAL_SEARCH_KWARGS)
+    
+    async def _embed_question(self, question: str) -> np.ndarray:
+        """Unit-length embedding of a question, so a dot product is its cosine similarity"""
+        vector = np.asarray(await self._embeddings.aembed_query(question), dtype="float32")
+        return vector / (np.linalg.norm(vector) or 1.0)
+    
+    def _lookup_similar_answer(self, question_vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached answer of the most similar earlier question, if it is close enough"""
+        if not self._query_cache:
+            return None
+        
+        cached_vectors = np.stack([vector for vector, _ in self._query_cache])
+        similarities = cached_vectors @ question_vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return self._query_cache[best][1]
+    
+    def _remember_answer(self, question_vector: np.ndarray, response: Dict[str, Any]):
+        """Cache an answer, dropping the oldest one once the cache is full"""
+        if len(self._query_cache) >= SEMANTIC_CACHE_SIZE:
+            self._query_cache.pop(0)
+        self._query_cache.append((question_vector, response))
+    
+    @staticmethod
+    def _summarize_sources(source_documents: List[Any]) -> tuple[List[str], List[Dict[str, Any]]]:
+        """Collect unique source names and per-chunk details for retrieved chunks"""
+        source_docs = {}  # Ordered set of source names
+        source_info = []
+        
+        for doc in source_documents:
+            source_name = doc.metadata.get("source", "Unknown")
+            chunk_info = f"Chunk {doc.metadata.get('chunk_id', 0) + 1}/{doc.metadata.get('total_chunks', 1)}"
+            
+            source_docs.setdefault(source_name, None)
+            
+            source_info.append({
+                "source": source_name,
+                "chunk_info": chunk_info,
+                "preview": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
+            })
+        
+        return list(source_docs), source_info
+    
+    async def reset(self):
         """Reset the retrieval service"""
+        async with self._lock:
+            self._reset_state()
+    
+    def _reset_state(self):
+        """Drop the vector store and everything derived from it; the caller holds self._lock"""
         self.vector_store = None
-        self.qa_chain = None
         self.document_count = 0
-        print("Retrieval service reset successfully")
+        self._query_cache.clear()
+        logger.debug("Retrieval service reset")
     
     def get_status(self) -> Dict[str, Any]:
         """Get current status of the retrieval service"""
@@ -182,21 +468,33 @@ class RetrievalService:
             "has_vector_store": self.vector_store is not None,
             "has_qa_chain": self.qa_chain is not None,
             "document_count": self.document_count,
-            "ready_for_queries": self.qa_chain is not None
+            "ready_for_queries": self.vector_store is not None
         }
     
-    def rebuild_vector_store_without_document(self, remaining_texts: List[str], remaining_names: List[str]):
-        """Rebuild vector store excluding deleted document"""
-        if not remaining_texts:
-            # No documents left, reset everything
-            self.reset()
+    async def remove_document(self, document_id: int):
+        """Drop one document's chunks from the vector store without re-embedding the others"""
+        async with self._lock:
+            await self._remove_document(document_id)
+    
+    async def _remove_document(self, document_id: int):
+        """Remove a document's chunks; the caller holds self._lock"""
+        if self.vector_store is None:
             return
         
-        print(f"Rebuilding vector store with {len(remaining_texts)} remaining documents...")
+        # A document's chunk ids are consecutive from document_id << CHUNK_ID_BITS
+        index_to_docstore_id = self.vector_store.index_to_docstore_id
+        first_chunk_id = document_id << CHUNK_ID_BITS
+        chunk_ids = list(itertools.takewhile(index_to_docstore_id.__contains__, itertools.count(first_chunk_id)))
         
-        # Recreate vector store with remaining documents
-        self.vector_store = self.create_vector_store(remaining_texts, remaining_names)
-        self.qa_chain = self.create_qa_chain(self.vector_store)
-        self.document_count = len(remaining_texts)
+        logger.info("Removing %d chunks of document %d from vector store", len(chunk_ids), document_id)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.vector_store.index.remove_ids, np.asarray(chunk_ids, dtype="int64"))
+        self.vector_store.docstore.delete([index_to_docstore_id.pop(chunk_id) for chunk_id in chunk_ids])
+        
+        self.document_count -= 1
+        if self.document_count <= 0:
+            self._reset_state()
+            return
         
-        print(f"Vector store rebuilt successfully with {self.document_count} documents")
+        self._query_cache.clear()
+        await self._save()
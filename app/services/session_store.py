@@ -0,0 +1,73 @@
+import json
+import os
+from typing import List, Dict, Any, Optional
+
+# Set to share session state between uvicorn workers, e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL")
+KEY_PREFIX = "ragbot"
+
+class SessionStore:
+    """Persists per-session document metadata in Redis so any worker can restore a session"""
+    
+    def __init__(self, client, ttl_seconds: int):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+    
+    @classmethod
+    def from_env(cls, ttl_seconds: int) -> Optional["SessionStore"]:
+        """Create a store from REDIS_URL, or return None to keep sessions in-process"""
+        if not REDIS_URL:
+            return None
+        
+        import redis.asyncio as redis
+        return cls(redis.from_url(REDIS_URL, decode_responses=True), ttl_seconds)
+    
+    @staticmethod
+    def _docs_key(session_id: str) -> str:
+        return f"{KEY_PREFIX}:{session_id}:docs"
+    
+    @staticmethod
+    def _meta_key(session_id: str) -> str:
+        return f"{KEY_PREFIX}:{session_id}:meta"
+    
+    async def save(self, session_id: str, documents: List[Dict[str, Any]], document_id_counter: int) -> int:
+        """Replace the stored snapshot of a session's documents and return its new version"""
+        docs_key = self._docs_key(session_id)
+        meta_key = self._meta_key(session_id)
+        
+        async with self.client.pipeline(transaction=True) as pipe:
+            # Bumped on every save so workers holding an older copy of the session know to reload it
+            pipe.hincrby(meta_key, "version", 1)
+            pipe.delete(docs_key)
+            if documents:
+                pipe.hset(docs_key, mapping={str(doc["id"]): json.dumps(doc) for doc in documents})
+                pipe.expire(docs_key, self.ttl_seconds)
+            pipe.hset(meta_key, mapping={"document_id_counter": document_id_counter})
+            pipe.expire(meta_key, self.ttl_seconds)
+            results = await pipe.execute()
+        return int(results[0])
+    
+    async def load(self, session_id: str) -> tuple[List[Dict[str, Any]], int, int]:
+        """Load a session's documents in upload order together with its document ID counter and version"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self._docs_key(session_id))
+            pipe.hmget(self._meta_key(session_id), "document_id_counter", "version")
+            stored_docs, (counter, version) = await pipe.execute()
+        
+        documents = sorted((json.loads(doc) for doc in stored_docs.values()), key=lambda doc: doc["id"])
+        return documents, int(counter or 0), int(version or 0)
+    
+    async def touch(self, session_id: str, extend: bool = True) -> int:
+        """Return a session's current version, first extending its expiry when it is still in use"""
+        meta_key = self._meta_key(session_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            if extend:
+                pipe.expire(self._docs_key(session_id), self.ttl_seconds)
+                pipe.expire(meta_key, self.ttl_seconds)
+            pipe.hget(meta_key, "version")
+            results = await pipe.execute()
+        return int(results[-1] or 0)
+    
+    async def exists(self, session_id: str) -> bool:
+        """Whether a session is still stored, i.e. its metadata has not expired"""
+        return bool(await self.client.exists(self._meta_key(session_id)))
@@ -18,5 +18,14 @@ if __name__ == "__main__":
     print("🏗️  Modular architecture loaded")
     print("🚀 Server starting on http://localhost:8000")
     
-    # Use import string to avoid reload warning
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    # Import string so uvicorn can spawn workers; uvloop + httptools for a C event loop and HTTP parser.
+    # Session state lives in each worker process, so keep WEB_CONCURRENCY at 1 unless sessions are shared.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=os.getenv("RELOAD") == "1"
+    )